@@ -1,11 +1,15 @@
 from sys import argv
-from collections import namedtuple
+from collections import namedtuple, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
 import random
 import pathlib
 import os
 import re
 
 import pandas as pd
+import numpy as np
 
 SUSPECT_DUPLICATES = ['M_PL_001', 'M_PL_002', 'M_PL_003',
                       'arroyo_1982_19810301_949', 'arroyo_1982_19810301_950',
@@ -15,6 +19,11 @@ SPECIES_SPATTERN = r' (?P<base>sp\.{0,2}|n\.i\.) ?' \
                    r'(?P<spindex>[0-9]*) ?' \
                    r'(?P<spnet>M_PL_[0-9]{3}(_[0-9]{0,3})?)? ?' \
                    r'(?P<spextra>.*)'
+SPECIES_REGEX = re.compile(SPECIES_SPATTERN)
+MISSING_SPECIES_REGEX = re.compile(r'(^sp$|n\.i\.|^sp[^a-z])')
+
+# networks, species patterns, name sets and threshold of a worker process of compare_all_networks
+WORKER_STATE = dict()
 
 SpeciesIdentifier = namedtuple('SpeciesIdentifier',
                                ['genus', 'species', 'index', 'network', 'extra', 'origin'])
@@ -31,11 +40,12 @@ def name_missing_structure(tax_name):
     """
     try:
         query_word = tax_name.split(' ')[1]
-        return re.match(r'(^sp$|n\.i\.|^sp[^a-z])', query_word)
+        return MISSING_SPECIES_REGEX.match(query_word)
     except IndexError:  # some tax names are just one word, can't do much with that
         return None
 
 
+@lru_cache(maxsize=None)
 def species_pattern(tax_name):
     """
     Parses a names of unidentified species to the following tokens:
@@ -44,7 +54,8 @@ def species_pattern(tax_name):
     - network identifier (special for WoL networks with M_PL_[XXX])
     - Extra information (usually a few capitalized letters)
     This breaking down of unknown species will allow for comparison by subsets
-    or specific criteria.
+    or specific criteria. Results are cached, as the same names recur across
+    many networks.
     :param tax_name: string with the species name as given in the network.
     :return: a regularized namedtuple of the species name
     """
@@ -54,12 +65,17 @@ def species_pattern(tax_name):
             genus=tax_words[0],
             species=tax_words[1] if len(tax_words) > 1 else '',
             index='', network='', origin=tax_name,
-            extra=tax_words[2:] if len(tax_words) > 2 else ''
+            extra=tuple(tax_words[2:]) if len(tax_words) > 2 else ''
         )
-        if not name_missing_structure(tax_name):
+        # unknown species identifiers open with 'sp' or 'n.i.', so most identified
+        # species are told apart by a substring check before splitting again.
+        if (' sp' not in tax_name and ' n.i.' not in tax_name) or \
+                not name_missing_structure(tax_name):
             return normal_structure
 
-        match = re.search(SPECIES_SPATTERN, tax_name)
+        # the second word was checked to open an unknown species identifier, so the
+        # pattern is matched anchored at the space following the genus.
+        match = SPECIES_REGEX.match(tax_name, len(tax_words[0]))
         if not match:
             return normal_structure
 
@@ -76,48 +92,55 @@ def species_pattern(tax_name):
         raise
 
 
-def parameterized_compare(a, b, allow_empty, *args):
+def parameter_getter(*args):
     """
-    Compares two elements: a and b, according to a list
-    of parameters, given as args.
-    :param a: first comparand.
-    :param b: second comparand.
-    :param allow_empty: allows comparing empty parameters. If False,
-    then (a.arg == b.arg && a.arg == '') will return False
-    :param args: parameters to compare by. If no parameters
-    are given, compare a == b.
-    :return: True if a and b have the same parameters.
+    Creates a function which returns the given parameters of a species pattern
+    as a tuple. Parameters are read by their position in SpeciesIdentifier, which
+    avoids the attribute lookup of each field.
+    :param args: parameters (SpeciesIdentifier fields) to get.
+    :return: function from a species pattern to the tuple of its parameters.
     """
-    if not args:
-        return a == b
-    return all([getattr(a, arg) == getattr(b, arg) and
-                (getattr(a, arg) != '' or allow_empty)
-                for arg in args])
+    getter = itemgetter(*(SpeciesIdentifier._fields.index(arg) for arg in args))
+    if len(args) == 1:
+        return lambda element: (getter(element),)
+    return getter
 
 
-def map_nodeset_by_parameters(set1, set2, map12, map21, cmp_empty, *args):
+def map_nodeset_by_levels(set1, set2, map12, map21, levels):
     """
-    Takes unmapped elements from set1 and set2 and maps between them by
-    the given comparison parameters.
+    Takes unmapped elements from set1 and set2 and maps between them by a
+    sequence of comparison levels. Unmapped elements of set2 are bucketed by
+    the parameter values of all levels in a single sweep. Each level then maps
+    all of set1 before the next level is used, each element of set1 being mapped
+    greedily to the first matching element of set2 which is still unmapped.
     :param set1: first set of mapping elements.
     :param set2: second set of mapping elements.
     :param map12: mapping from set1 elements to set2.
     :param map21: mapping from set2 elements to set1.
-    :param cmp_empty: consider empty parameters comparable.
-    :param args: comparison parameters.
+    :param levels: list of (cmp_empty, parameters) pairs, by order of use, where
+    cmp_empty is whether to consider empty parameters comparable.
     :return: None, but mutates map parameters.
     """
-    for cmpa in set1:
-        if cmpa.origin in map12:
+    level_getters = [(cmp_empty, parameter_getter(*args)) for cmp_empty, args in levels]
+    level_buckets = [defaultdict(deque) for _ in levels]
+    for cmpb in set2:
+        if cmpb.origin in map21:
             continue
-
-        for cmpb in set2:
-            if cmpb.origin in map21:
+        for (cmp_empty, get_parameters), buckets in zip(level_getters, level_buckets):
+            key = get_parameters(cmpb)
+            if cmp_empty or '' not in key:
+                buckets[key].append(cmpb)
+
+    for (_, get_parameters), buckets in zip(level_getters, level_buckets):
+        for cmpa in set1:
+            if cmpa.origin in map12:
                 continue
 
-            if parameterized_compare(cmpa, cmpb, not cmp_empty, *args) \
-                    and not map21.get(cmpb.origin, None):
-                # print("mapping ", cmpa.origin, " to ", cmpb.origin, " by ", args)
+            matches = buckets.get(get_parameters(cmpa))
+            while matches:
+                cmpb = matches.popleft()
+                if cmpb.origin in map21:  # mapped in a previous level
+                    continue
                 map12[cmpa.origin] = cmpb.origin
                 map21[cmpb.origin] = cmpa.origin
                 break
@@ -132,17 +155,17 @@ def map_non_matches(key_set, mapping):
     :param mapping: dictionary mapping to complete.
     :return: None, but mutates mapping patameter.
     """
-    for key in key_set:
-        if key not in mapping.keys():
-            mapping[key] = None
+    mapping.update(dict.fromkeys(key_set - mapping.keys()))
 
 
-def map_nodeset(set1, set2):
+def map_nodeset(set1, set2, pset1=None, pset2=None):
     """
     Given two sets of network nodes labeled by species names, maps
     the names between the nodes in each set, first by full text comparison,
     then by a diminishing number of parameters using the species pattern.
     Assumes all node names in a network are unique.
+    :param pset1: species patterns of set1 nodes, parsed from set1 if not given.
+    :param pset2: species patterns of set2 nodes, parsed from set2 if not given.
     :return: quadruple of the following:
     1. mapping from set1 to set2 nodes.
     2. reverse mapping from set2 to set1 nodes.
@@ -151,22 +174,73 @@ def map_nodeset(set1, set2):
     Note that nodes without mapping are mapped to None in 1. and 2.
     """
     nonspecific_parameters = ['genus', 'index', 'network', 'extra']
-    map1to2, map2to1 = dict(), dict()
 
-    pset1 = [species_pattern(sp_string) for sp_string in set1]
-    pset2 = [species_pattern(sp_string) for sp_string in set2]
-    map_nodeset_by_parameters(pset1, pset2, map1to2, map2to1, True, 'origin')
-    for stop in range(len(nonspecific_parameters), 1, -1):
-        map_nodeset_by_parameters(pset1, pset2, map1to2, map2to1, False,
-                                  *nonspecific_parameters[:stop])
-    map_nodeset_by_parameters(pset1, pset2, map1to2, map2to1, True, 'species')
-
-    unmapped1, unmapped2 = set1 - set(map1to2.keys()), set2 - set(map2to1.keys())
+    # identical names are mapped to each other up front, so only the remaining
+    # names need to be parsed and mapped by their species pattern.
+    shared = set1 & set2
+    map1to2, map2to1 = dict(zip(shared, shared)), dict(zip(shared, shared))
+
+    if pset1 is None:
+        pset1 = [species_pattern(sp_string) for sp_string in set1 if sp_string not in shared]
+    else:
+        pset1 = [pattern for pattern in pset1 if pattern.origin not in shared]
+    if pset2 is None:
+        pset2 = [species_pattern(sp_string) for sp_string in set2 if sp_string not in shared]
+    else:
+        pset2 = [pattern for pattern in pset2 if pattern.origin not in shared]
+
+    mapping_levels = [(True, nonspecific_parameters[:stop])
+                      for stop in range(len(nonspecific_parameters), 1, -1)]
+    mapping_levels.append((False, ['species']))
+    map_nodeset_by_levels(pset1, pset2, map1to2, map2to1, mapping_levels)
+
+    unmapped1, unmapped2 = set1 - map1to2.keys(), set2 - map2to1.keys()
     map_non_matches(set1, map1to2)
     map_non_matches(set2, map2to1)
     return map1to2, map2to1, unmapped1, unmapped2
 
 
+def mapping_positions(labels, mapped_labels, mapping):
+    """
+    Translates a mapping between node labels of two networks to positions.
+    :param labels: node labels of the first network.
+    :param mapped_labels: node labels of the second network.
+    :param mapping: mapping from first network labels to second network labels.
+    :return: integer array with the position in mapped_labels of each label's
+    mapping, or -1 for labels without a mapping.
+    """
+    return mapped_labels.get_indexer([mapping[label] for label in labels])
+
+
+def count_missing_interactions(net1, net2, plant_map, pol_map, compare_value=False,
+                               count_nomaps=False):
+    """
+    Goes over the interactions of net1 (non-zero entries only), and counts the
+    interactions missing from net2 using the mappings from net1 nodes to net2 nodes.
+    :param count_nomaps: Count missing interaction when one of the nodes has no
+    mapping to the other network.
+    :param compare_value: Count interactions with different values as "missing".
+    :return: A tuple of the total number of interactions in net1, and the number
+    of them missing in net2.
+    """
+    interactions, mapped_interactions = net1.to_numpy(), net2.to_numpy()
+    plant_positions = mapping_positions(net1.index, net2.index, plant_map)
+    pol_positions = mapping_positions(net1.columns, net2.columns, pol_map)
+
+    plant_ids, pol_ids = np.nonzero(interactions)
+    mapped_plants, mapped_pols = plant_positions[plant_ids], pol_positions[pol_ids]
+    is_mapped = (mapped_plants >= 0) & (mapped_pols >= 0)
+
+    values = interactions[plant_ids[is_mapped], pol_ids[is_mapped]]
+    mapped_values = mapped_interactions[mapped_plants[is_mapped], mapped_pols[is_mapped]]
+    missing = mapped_values == 0
+    if compare_value:
+        missing |= mapped_values != values
+
+    nomaps = len(plant_ids) - np.count_nonzero(is_mapped) if count_nomaps else 0
+    return len(plant_ids), np.count_nonzero(missing) + nomaps
+
+
 def compare_network_interactions(net1, net2, plant_map12, plant_map21,
                                  pol_map12, pol_map21, compare_value=False,
                                  count_nomaps=False):
@@ -185,47 +259,15 @@ def compare_network_interactions(net1, net2, plant_map12, plant_map21,
     """
     # go over both networks, when going over network1, count interactions to
     # net1 total and missing interactions to net2 missing. Likewise for net2.
-    net1_total, net2_total = 0, 0
-    net1_missing, net2_missing = 0, 0
-
-    for plant_name, plant_row in net1.iterrows():
-        for pol_name, pol_interaction in plant_row.iteritems():
-            if pol_interaction == 0:
-                continue
-
-            net1_total += 1
-            mapped_plant = plant_map12[plant_name]
-            mapped_pol = pol_map12[pol_name]
-            # print(f"({plant_name},{pol_name}) => ({mapped_plant}, {mapped_pol})")
-
-            if not (mapped_pol and mapped_plant):
-                net2_missing += (1 if count_nomaps else 0)
-                continue
-
-            if (net2.loc[mapped_plant, mapped_pol] != pol_interaction and compare_value) or \
-                    not net2.loc[mapped_plant, mapped_pol]:
-                net2_missing += 1
-
-    for plant_name, plant_row in net2.iterrows():
-        for pol_name, pol_interaction in plant_row.iteritems():
-            if pol_interaction == 0:
-                continue
-
-            net2_total += 1
-            mapped_plant = plant_map21[plant_name]
-            mapped_pol = pol_map21[pol_name]
-            if not (mapped_pol and mapped_plant):
-                net1_missing += (1 if count_nomaps else 0)
-                continue
-
-            if (net1.loc[mapped_plant, mapped_pol] != pol_interaction and compare_value) or \
-                    not net1.loc[mapped_plant, mapped_pol]:
-                net1_missing += 1
-
+    net1_total, net2_missing = count_missing_interactions(
+        net1, net2, plant_map12, pol_map12, compare_value, count_nomaps)
+    net2_total, net1_missing = count_missing_interactions(
+        net2, net1, plant_map21, pol_map21, compare_value, count_nomaps)
     return net1_missing, net2_missing, net1_total, net2_total
 
 
-def compare_networks(net1, net2, ct=0.05, log=False):
+def compare_networks(net1, net2, ct=0.05, log=False, patterns1=None, patterns2=None,
+                     names1=None, names2=None):
     """
     Takes two networks and compares them according to matching in
     plant/pollinator/interaction elements and set sizes.
@@ -233,6 +275,12 @@ def compare_networks(net1, net2, ct=0.05, log=False):
     mean plant/pollinator/interaction number).
     :param log: print the whether the networks are duplicate,
     and why not.
+    :param patterns1: precomputed (plant, pollinator) species patterns of net1,
+    as given by precompute_patterns.
+    :param patterns2: precomputed (plant, pollinator) species patterns of net2.
+    :param names1: precomputed (plant, pollinator) name sets of net1,
+    as given by precompute_name_sets.
+    :param names2: precomputed (plant, pollinator) name sets of net2.
     :return: True if networks are duplicates, False otherwise.
     """
     plantsize1, polsize1 = len(net1.index), len(net1.columns)
@@ -240,21 +288,25 @@ def compare_networks(net1, net2, ct=0.05, log=False):
     plant_threshold = (plantsize1 + plantsize2) / 2 * ct
     pol_threshold = (polsize1 + polsize2) / 2 * ct
 
-    if abs(plantsize1 - plantsize2) > plant_threshold:
+    if not sizes_match(plantsize1, plantsize2, ct):
         if log:
             print(f"-->Networks are not duplicates due to different plant sizes: "
                   f"{plantsize1} || {plantsize2}")
         return False
-    if abs(polsize1 - polsize2) > pol_threshold:
+    if not sizes_match(polsize1, polsize2, ct):
         if log:
             print(f"-->Networks are not duplicate due to different pollinator sizes: "
                   f"{polsize1} || {polsize2}")
         return False
 
+    plant_patterns1, pol_patterns1 = patterns1 if patterns1 else (None, None)
+    plant_patterns2, pol_patterns2 = patterns2 if patterns2 else (None, None)
+    plants1, pols1 = names1 if names1 else (set(net1.index), set(net1.columns))
+    plants2, pols2 = names2 if names2 else (set(net2.index), set(net2.columns))
     plants1to2, plants2to1, plants1_unmapped, plants2_unmapped = map_nodeset(
-        set(net1.index), set(net2.index))
+        plants1, plants2, plant_patterns1, plant_patterns2)
     pols1to2, pols2to1, pols1_unmapped, pols2_unmapped = map_nodeset(
-        set(net1.columns), set(net2.columns))
+        pols1, pols2, pol_patterns1, pol_patterns2)
 
     if len(plants1_unmapped | plants2_unmapped) > plant_threshold:
         if log:
@@ -298,26 +350,154 @@ def drop_network(net1, net2):
     return random.random() > 0.5
 
 
-def compare_all_networks(networks, threshold, drop_early=frozenset(), log=False):
+def precompute_patterns(networks, names=None):
+    """
+    Parses the species patterns of all plants and pollinators in each network
+    once, so they can be reused across all network comparisons.
+    :param networks: dictionary of network names to network tables.
+    :param names: names of the networks to parse, all networks if not given.
+    :return: dictionary of network names to (plant patterns, pollinator patterns).
+    """
+    names = networks.keys() if names is None else names
+    return {name: (tuple(map(species_pattern, networks[name].index)),
+                   tuple(map(species_pattern, networks[name].columns)))
+            for name in names}
+
+
+def precompute_name_sets(networks, names=None):
+    """
+    Builds the sets of plant and pollinator names of each network once,
+    so they can be reused across all network comparisons.
+    :param networks: dictionary of network names to network tables.
+    :param names: names of the networks to build sets for, all networks if not given.
+    :return: dictionary of network names to (plant names, pollinator names).
+    """
+    names = networks.keys() if names is None else names
+    return {name: (frozenset(networks[name].index), frozenset(networks[name].columns))
+            for name in names}
+
+
+def sizes_match(size1, size2, ct):
+    """
+    Checks whether two node set sizes are close enough for their networks
+    to be considered duplicates, as done in compare_networks.
+    :param ct: comparison threshold (multiplied by the mean size).
+    """
+    return abs(size1 - size2) <= (size1 + size2) / 2 * ct
+
+
+def size_candidates(networks, ct):
+    """
+    Blocks networks into candidate duplicate pairs by their plant and pollinator
+    numbers. Networks are swept in order of plant number, so each network is only
+    paired with the following networks until the plant numbers no longer match.
+    This is exact: any pair left out would be rejected by compare_networks.
+    :param networks: dictionary of network names to network tables.
+    :param ct: comparison threshold, as in compare_networks.
+    :return: dictionary mapping each network name to the set of candidate
+    networks whose names come after it in sorted order.
+    """
+    sizes = {name: net.shape for name, net in networks.items()}
+    by_plants = sorted(sizes, key=lambda name: sizes[name][0])
+    candidates = {name: set() for name in sizes}
+
+    for i, name_i in enumerate(by_plants):
+        plants_i, pols_i = sizes[name_i]
+        for name_j in by_plants[i + 1:]:
+            plants_j, pols_j = sizes[name_j]
+            if not sizes_match(plants_i, plants_j, ct):
+                break
+            if sizes_match(pols_i, pols_j, ct):
+                candidates[min(name_i, name_j)].add(max(name_i, name_j))
+
+    return candidates
+
+
+def init_compare_worker(networks, patterns, names, ct):
+    """
+    Stores the networks compared by a worker process and their precomputed
+    species patterns and name sets, so they are sent to each worker once
+    instead of with every network pair.
+    """
+    WORKER_STATE.update(networks=networks, patterns=patterns, names=names, ct=ct)
+
+
+def compare_network_pair(pair):
+    """
+    Compares a pair of networks stored by init_compare_worker.
+    :param pair: names of the two networks to compare.
+    :return: True if networks are duplicates, False otherwise.
+    """
+    net_i, net_j = pair
+    networks = WORKER_STATE['networks']
+    patterns = WORKER_STATE['patterns']
+    names = WORKER_STATE['names']
+    return compare_networks(networks[net_i], networks[net_j], ct=WORKER_STATE['ct'],
+                            patterns1=patterns[net_i], patterns2=patterns[net_j],
+                            names1=names[net_i], names2=names[net_j])
+
+
+def compare_all_networks(networks, threshold, drop_early=frozenset(), log=False, workers=None):
+    """
+    Finds duplicate networks by comparing all networks of similar sizes,
+    and chooses which network of each duplicate pair to drop.
+    :param networks: dictionary of network names to network tables.
+    :param threshold: comparison threshold, as in compare_networks.
+    :param drop_early: networks already known to be dropped.
+    :param log: print network comparisons and their results.
+    :param workers: number of worker processes to compare networks in. If
+    given, all candidate pairs are compared in parallel before duplicates
+    are chosen, and only the compared pairs are logged.
+    :return: set of names of networks to drop.
+    """
     # sort net keys to get consistent number of duplicates for each run
     net_keys = sorted(list(networks.keys()))
     duplicate_networks = set(drop_early)
-
-    for i in range(len(net_keys)):
-        net_i = net_keys[i]
+    net_candidates = size_candidates(networks, threshold)
+    # patterns and name sets are only built for networks that are compared, as
+    # networks dropped early or with no candidates may have unparsable labels.
+    net_patterns, net_names = dict(), dict()
+
+    pair_duplicates = dict()
+    if workers:
+        # network comparisons are independent, only choosing which duplicate
+        # to drop depends on earlier choices, so it is done afterwards in order.
+        pairs = [(net_i, net_j) for net_i in net_keys if net_i not in duplicate_networks
+                 for net_j in sorted(net_candidates[net_i]) if net_j not in duplicate_networks]
+        compared = sorted({name for pair in pairs for name in pair})
+        net_patterns = precompute_patterns(networks, compared)
+        net_names = precompute_name_sets(networks, compared)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_compare_worker,
+                                 initargs=(networks, net_patterns, net_names, threshold)) as executor:
+            chunksize = max(1, len(pairs) // (workers * 4))
+            pair_duplicates = dict(zip(pairs, executor.map(compare_network_pair, pairs,
+                                                           chunksize=chunksize)))
+
+    for net_i in net_keys:
         if net_i in duplicate_networks:
             continue
 
-        for j in range(i + 1, len(net_keys)):
-            net_j = net_keys[j]
+        for net_j in sorted(net_candidates[net_i]):
             if net_j in duplicate_networks:
                 continue
 
             if log:
                 print(f"\ncomparing: [{net_i}] || [{net_j}]")
 
-            if compare_networks(networks[net_i], networks[net_j],
-                                ct=threshold, log=log):
+            if workers:
+                duplicates = pair_duplicates[(net_i, net_j)]
+            else:
+                for name in (net_i, net_j):
+                    if name not in net_patterns:
+                        net_patterns.update(precompute_patterns(networks, [name]))
+                        net_names.update(precompute_name_sets(networks, [name]))
+                duplicates = compare_networks(networks[net_i], networks[net_j],
+                                              ct=threshold, log=log,
+                                              patterns1=net_patterns[net_i],
+                                              patterns2=net_patterns[net_j],
+                                              names1=net_names[net_i],
+                                              names2=net_names[net_j])
+            if duplicates:
                 drop_j = drop_network(networks[net_i], networks[net_j])
                 duplicate_networks.add(net_j if drop_j else net_i)
                 # print(f"{net_i} ]=DUPLICATES=[ {net_j}")
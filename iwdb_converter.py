@@ -1,24 +1,19 @@
 from sys import argv
 import os
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 
 
 def convert_table(src_file, dest_file):
     raw_table = pd.read_excel(src_file)
-    plants = raw_table.iloc[0:1, :]
-    pollinators = raw_table.iloc[:, 0:2]
-
-    pollinators_clean = []
-    for row_id, row in pollinators.iterrows():
-        pollinators_clean.append(str(row[0]) + ' ' + str(row[1]))
-    pollinators_clean = pollinators_clean[2:]
-
-    plants_clean = []
-    for label, value in plants.iteritems():
-        plants_clean.append(str(label) + ' ' + str(value[0]))
-    plants_clean = plants_clean[3:]
+    # plant names are split between the column labels and the first row, and
+    # pollinator names between the first two columns.
+    pollinators_clean = [str(genus) + ' ' + str(species) for genus, species in
+                         zip(raw_table.iloc[2:, 0], raw_table.iloc[2:, 1])]
+    plants_clean = [str(genus) + ' ' + str(species) for genus, species in
+                    zip(raw_table.columns[3:], raw_table.iloc[0, 3:])]
 
     clean_table = raw_table.drop(index=[0, 1]).drop(
         columns=raw_table.columns[0:3]).fillna(0)
@@ -33,19 +28,23 @@ def convert_format(src_file, dest_file):
     table.to_csv(dest_file)
 
 
-def convert_directory(src_dir, dest_dir, iwdb_format=True):
-    for src_name in os.listdir(src_dir):
-        if iwdb_format:
-            convert_table(
-                src_dir.joinpath(src_name),
-                dest_dir.joinpath(src_name).with_suffix('.csv')
-            )
-        else:
-            convert_format(
-                src_dir.joinpath(src_name),
-                dest_dir.joinpath(src_name).with_suffix('.csv')
-            )
-        print(f"done converting {src_name}")
+def convert_directory(src_dir, dest_dir, iwdb_format=True, workers=None):
+    """
+    Converts all tables in a directory to csv files in the destination directory.
+    Tables are independent, so they are converted in parallel worker processes.
+    :param iwdb_format: convert tables from the IWDB format, otherwise
+    just change the file format.
+    :param workers: maximal number of worker processes (defaults to the number
+    of processors).
+    """
+    converter = convert_table if iwdb_format else convert_format
+    src_names = os.listdir(src_dir)
+    src_files = [src_dir.joinpath(src_name) for src_name in src_names]
+    dest_files = [dest_dir.joinpath(src_name).with_suffix('.csv') for src_name in src_names]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for src_name, _ in zip(src_names, executor.map(converter, src_files, dest_files)):
+            print(f"done converting {src_name}")
 
 
 if __name__ == "__main__":
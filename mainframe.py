@@ -1,7 +1,12 @@
 from sys import argv
+import sys
 import pathlib
 import random
 import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
 
 import pandas as pd
 import numpy as np
@@ -12,6 +17,34 @@ from duplicate_finder import compare_all_networks
 from network_analysis import rank_graph, network_nodf, get_fractional_indices
 from phylogenetic_tree import generate_sparse_tree, closest_leaf_distances
 
+# parse network csv files with pyarrow and cache them as parquet files (requires pyarrow).
+FAST_IO = os.environ.get('NETLAB_FAST_IO', '0') == '1'
+# reuse network analysis results of previous runs whose inputs are unchanged.
+REUSE_RESULTS = os.environ.get('NETLAB_REUSE_RESULTS', '0') == '1'
+# version of the network analysis and its result layout. Bump it whenever ranking, nestedness
+# or the result file change, so results stored by previous versions are not reused.
+ANALYSIS_VERSION = 1
+
+
+def unidentified_labels(labels):
+    """
+    Marks the labels of COMPLETELY unidentified species, named `unidentified`
+    in the network, using vectorized string operations. Labels that are not
+    strings (e.g. numbered species) are matched by their string form.
+    :param labels: pandas index of species names (network rows or columns).
+    :return: boolean numpy array, True for unidentified species.
+    """
+    return labels.astype(str).str.lower().str.startswith('unidentified')
+
+
+def unidentified_fraction(unidentified):
+    """
+    Computes the fraction of unidentified species on a network axis.
+    :param unidentified: boolean array, as given by unidentified_labels.
+    :return: fraction of unidentified species, 0 for an empty axis.
+    """
+    return unidentified.mean() if len(unidentified) else 0.0
+
 
 def unidentified_rate(net_table):
     """
@@ -22,106 +55,227 @@ def unidentified_rate(net_table):
     :param net_table: pandas table of a pollinator network
     :return: tuple of unknown plant and pollinator rates.
     """
-    unidentified_plants = sum(1 if p.lower().startswith('unidentified') else 0
-                              for p in net_table.index)
-    unidentified_pols = sum(1 if p.lower().startswith('unidentified') else 0
-                            for p in net_table.columns)
-    return unidentified_plants / len(net_table.index), unidentified_pols / len(net_table.columns)
+    return (unidentified_fraction(unidentified_labels(net_table.index)),
+            unidentified_fraction(unidentified_labels(net_table.columns)))
 
 
 def clean_networks(networks, plant_threshold=0.25, pol_threshold=1.0,
                    clean_plants=False, clean_pollinators=False):
     partial_networks = set()
+    cleaned_networks = dict()
 
-    for net_name in networks.keys():
-        ref_net = networks[net_name]
-
+    for net_name, ref_net in networks.items():
         try:
-            missing_plants, missing_pols = unidentified_rate(ref_net)
+            unidentified_plants = unidentified_labels(ref_net.index)
+            unidentified_pols = unidentified_labels(ref_net.columns)
         except Exception:
             print(net_name, "\n", ref_net)
             raise
 
+        # the same label masks give both the unidentified rates and the species to drop
+        missing_plants = unidentified_fraction(unidentified_plants)
+        missing_pols = unidentified_fraction(unidentified_pols)
         if clean_pollinators or clean_plants:
-            known_cols = [not (c.lower().startswith('unidentified') and clean_pollinators)
-                          for c in ref_net.columns]
-            known_rows = [not (r.lower().startswith('unidentified') and clean_plants)
-                          for r in ref_net.index]
+            known_rows = ~unidentified_plants if clean_plants else slice(None)
+            known_cols = ~unidentified_pols if clean_pollinators else slice(None)
 
-            dropped_net = ref_net.loc[known_rows, known_cols]
-            networks[net_name] = dropped_net
+            cleaned_networks[net_name] = ref_net.iloc[known_rows, known_cols]
 
         if missing_plants > plant_threshold or missing_pols > pol_threshold:
             partial_networks.add(net_name)
 
+    networks.update(cleaned_networks)
     return partial_networks
 
 
 def iter_sources(source_directories):
     for src in source_directories:
-        for file in os.listdir(src):
-            if file.endswith('csv'):
-                yield src.joinpath(file)
+        with os.scandir(src) as entries:
+            for entry in entries:
+                if entry.name.endswith('.csv') and entry.is_file():
+                    yield pathlib.Path(entry.path)
+
+
+def intern_labels(labels):
+    """
+    Interns the string labels of a network axis. Species names recur across
+    many networks, so interning keeps a single string per name and lets
+    name hashing and comparison in duplicate_finder work on shared strings.
+    :param labels: pandas index of network labels.
+    :return: pandas index of the interned labels.
+    """
+    return pd.Index([sys.intern(label) if type(label) is str else label for label in labels],
+                    name=labels.name)
+
+
+def read_network(net_file):
+    """
+    Reads a network table from a csv file. If FAST_IO is set, the csv is parsed
+    by the pyarrow engine and cached as a parquet file next to it, which is read
+    instead as long as it is newer than the csv.
+    :param net_file: path of the network csv file.
+    :return: pandas table of the network, with interned labels.
+    """
+    if not FAST_IO:
+        net_table = pd.read_csv(net_file, index_col=0)
+    else:
+        parquet_file = net_file.with_suffix('.parquet')
+        if parquet_file.exists() and parquet_file.stat().st_mtime >= net_file.stat().st_mtime:
+            net_table = pd.read_parquet(parquet_file)
+        else:
+            net_table = pd.read_csv(net_file, index_col=0, engine='pyarrow')
+            net_table.to_parquet(parquet_file)
+
+    net_table.index = intern_labels(net_table.index)
+    net_table.columns = intern_labels(net_table.columns)
+    return net_table
 
 
 def extract_networks(source_directories):
-    all_networks = dict()
+    network_files = dict()
     duplicate_names = []
     for net_file in iter_sources(source_directories):
-        if net_file.stem not in all_networks:
-            all_networks[net_file.stem] = pd.read_csv(net_file, index_col=0)
+        if net_file.stem not in network_files:
+            network_files[net_file.stem] = net_file
         else:
             duplicate_names.append(net_file)
 
+    # csv parsing is mostly done outside the GIL, so files are read concurrently
+    with ThreadPoolExecutor() as executor:
+        all_networks = dict(zip(network_files.keys(),
+                                executor.map(read_network, network_files.values())))
     return all_networks, duplicate_names
 
 
 def permute_table(table, row_order, column_order):
-    ordered = table.reindex(row_order, axis='index')
-    ordered = ordered.reindex(column_order, axis='columns')
-    return ordered
-
-
-def analyze_networks(networks, polyploids, phylogenetic_tree, result_path, measure='pg'):
-    for name, table in networks.items():
-        net_poly = polyploids[name]
-
-        r_plants, r_pols = rank_graph(table, measure_by=measure)
-        polyploid_indices = get_fractional_indices(r_plants, net_poly)
-        """try:
-            plants_fixed = ['_'.join(k.split()).lower() for k in r_plants.keys()]
-            missing_in_tree = verify_in_tree(plants_fixed, phylogenetic_tree)  # verify with ALLMB tree in browser
-            print(f"\n{missing_in_tree}/{len(r_plants)} of network {name} not found in tree.\n")
-        except ValueError:
-            print(f"failed to get whole tree for {name}")"""
-
-        ordered_table = permute_table(
-            table,
-            sorted(r_plants.keys(), key=r_plants.get, reverse=True),
-            sorted(r_pols, key=r_pols.get, reverse=True)
-        )
-        nodf, nodf_contributions = network_nodf(ordered_table)
-
-        with open(result_path.joinpath(name), mode='w') as fp:
-            fp.write(f"{len(r_plants)} {len(r_pols)}\n")  # total number of plants and pollinators for ref
-            fp.write(f"{len(net_poly) / len(r_plants)}\n\n")  # polyploid fraction of plants
-
-            for poly_sp in net_poly:  # raw polyploid measure
-                fp.write(f"{r_plants[poly_sp]}\n")
-            fp.write(f"\n{np.mean([r_plants[k] for k in net_poly])}\n\n")  # mean of polyploid measures
-
-            for poly_sp in net_poly:  # polyploid importance indices by measure (higher == better)
-                fp.write(f"{polyploid_indices[poly_sp]}\n")
-            fp.write(f"\n{np.mean([v for k, v in polyploid_indices.items()])}\n\n")  # mean importance
-
-            plant_mean_nodf = np.mean([v for k, v in nodf_contributions.items()])
-            poly_mean_nodf = np.mean([nodf_contributions[k] for k in net_poly])
-            try:
-                fp.write(f"{poly_mean_nodf / plant_mean_nodf}\n")  # polyploid nodf contribution
-            except FloatingPointError:
-                assert poly_mean_nodf == 0.0 and plant_mean_nodf == 0.0, (poly_mean_nodf, plant_mean_nodf)
-                fp.write(f"{0.0}\n")  # in case of no nestedness at all
-                # this only happens in ponisio_2017_20140101_1319, which has 3 plants and 3 pollinators
+    """
+    Orders the rows and columns of a network table.
+    :param table: pandas table of the network.
+    :param row_order: row labels in their new order.
+    :param column_order: column labels in their new order.
+    :return: the ordered table, with rows and columns missing from the
+    table filled with NaN.
+    """
+    row_positions = table.index.get_indexer(row_order)
+    column_positions = table.columns.get_indexer(column_order)
+    if (row_positions < 0).any() or (column_positions < 0).any():
+        return table.reindex(index=row_order, columns=column_order)
+
+    # both orders are permutations of existing labels, so a single positional
+    # gather replaces reindexing each axis in turn.
+    return table.iloc[row_positions, column_positions]
+
+
+def rank_order(ranks):
+    """
+    Orders nodes by descending rank. Equally ranked nodes keep their order in ranks.
+    :param ranks: dictionary of nodes to their rank.
+    :return: numpy array of the nodes, sorted by descending rank.
+    """
+    nodes = np.array(list(ranks.keys()), dtype=object)
+    values = np.fromiter(ranks.values(), dtype=float, count=len(ranks))
+    return nodes[np.argsort(-values, kind='stable')]
+
+
+def analysis_key(table, net_poly, measure):
+    """
+    Hashes the inputs of a network analysis along with ANALYSIS_VERSION, to tell
+    whether a stored result of the analysis is still up to date.
+    :param table: pandas table of the network.
+    :param net_poly: polyploid plants of the network.
+    :param measure: measure to rank network nodes by.
+    :return: hex digest of the analysis inputs.
+    """
+    key = hashlib.sha1(pd.util.hash_pandas_object(table).values.tobytes())
+    for key_part in (table.columns, sorted(net_poly), [measure, ANALYSIS_VERSION]):
+        key.update('\n'.join(map(str, key_part)).encode() + b'\0')
+    return key.hexdigest()
+
+
+def analyze_network(name, table, net_poly, result_path, measure='pg', reuse=False):
+    """
+    Ranks the plants of a single network and writes the importance and nestedness
+    contribution of its polyploid plants to a result file named after the network.
+    :param name: network name.
+    :param table: pandas table of the network.
+    :param net_poly: polyploid plants of the network.
+    :param result_path: directory to write the network result file to.
+    :param measure: measure to rank network nodes by.
+    :param reuse: skip the analysis if the network has a result file from the
+    same inputs, as recorded in a hidden key file next to it. The key file is
+    written with every result, whether or not reuse is set.
+    """
+    key_file = result_path.joinpath(f".{name}.key")
+    key = analysis_key(table, net_poly, measure)
+    if reuse and result_path.joinpath(name).is_file() and key_file.is_file() and key_file.read_text() == key:
+        return
+    # the old key no longer describes the result file once it is rewritten
+    key_file.unlink(missing_ok=True)
+
+    r_plants, r_pols = rank_graph(table, measure_by=measure)
+    polyploid_indices = get_fractional_indices(r_plants, net_poly)
+    """try:
+        plants_fixed = ['_'.join(k.split()).lower() for k in r_plants.keys()]
+        missing_in_tree = verify_in_tree(plants_fixed, phylogenetic_tree)  # verify with ALLMB tree in browser
+        print(f"\n{missing_in_tree}/{len(r_plants)} of network {name} not found in tree.\n")
+    except ValueError:
+        print(f"failed to get whole tree for {name}")"""
+
+    ordered_table = permute_table(table, rank_order(r_plants), rank_order(r_pols))
+    nodf, nodf_contributions = network_nodf(ordered_table)
+
+    poly_ranks = [r_plants[poly_sp] for poly_sp in net_poly]
+    poly_importance = [polyploid_indices[poly_sp] for poly_sp in net_poly]
+    importance = np.fromiter(polyploid_indices.values(), dtype=float, count=len(polyploid_indices))
+    plant_nodf = np.fromiter(nodf_contributions.values(), dtype=float, count=len(nodf_contributions))
+
+    plant_mean_nodf = plant_nodf.mean()
+    poly_mean_nodf = np.mean([nodf_contributions[k] for k in net_poly])
+    try:
+        poly_nodf_ratio = poly_mean_nodf / plant_mean_nodf
+    except FloatingPointError:
+        assert poly_mean_nodf == 0.0 and plant_mean_nodf == 0.0, (poly_mean_nodf, plant_mean_nodf)
+        poly_nodf_ratio = 0.0  # in case of no nestedness at all
+        # this only happens in ponisio_2017_20140101_1319, which has 3 plants and 3 pollinators
+
+    # the result is assembled first and written at once
+    result = (
+        f"{len(r_plants)} {len(r_pols)}\n"  # total number of plants and pollinators for ref
+        f"{len(net_poly) / len(r_plants)}\n\n"  # polyploid fraction of plants
+        + ''.join(f"{rank}\n" for rank in poly_ranks)  # raw polyploid measure
+        + f"\n{np.mean(poly_ranks)}\n\n"  # mean of polyploid measures
+        + ''.join(f"{index}\n" for index in poly_importance)  # polyploid importance indices (higher == better)
+        + f"\n{importance.mean()}\n\n"  # mean importance
+        + f"{poly_nodf_ratio}\n"  # polyploid nodf contribution
+    )
+    with open(result_path.joinpath(name), mode='w') as fp:
+        fp.write(result)
+
+    # the key is only put in place once the result is complete
+    temp_key_file = result_path.joinpath(f".{name}.key.tmp")
+    temp_key_file.write_text(key)
+    os.replace(temp_key_file, key_file)
+
+
+def analyze_networks(networks, polyploids, phylogenetic_tree, result_path, measure='pg', workers=None,
+                     reuse=False):
+    """
+    Analyzes all given networks, see analyze_network.
+    :param workers: number of worker processes to analyze networks in. Networks
+    are analyzed serially if not given.
+    :param reuse: skip networks with up to date results from previous runs.
+    """
+    if not workers:
+        for name, table in networks.items():
+            analyze_network(name, table, polyploids[name], result_path, measure, reuse)
+        return
+
+    names = list(networks.keys())
+    # workers follow the floating point error handling of the calling process
+    with ProcessPoolExecutor(max_workers=workers, initializer=partial(np.seterr, **np.geterr())) as executor:
+        list(executor.map(analyze_network, names, [networks[name] for name in names],
+                          [polyploids[name] for name in names], repeat(result_path), repeat(measure),
+                          repeat(reuse)))
 
 
 if __name__ == "__main__":
@@ -142,7 +296,7 @@ if __name__ == "__main__":
     print(f"{len(duplicates)} duplicates found")
     network_polyploids = dict()
     for name, table in network_tables.items():
-        polies = {pn for pn in table.index if polydict.test_ploidy(pn)}
+        polies = polydict.definite.intersection(table.index)  # same as test_ploidy, in a single set operation
         if len(polies) > 0:
             network_polyploids[name] = polies
 
@@ -158,4 +312,4 @@ if __name__ == "__main__":
 
     print(f"analyzing {len(networks_to_analyze)} networks")
     analyze_networks(networks_to_analyze, network_polyploids, phylo_tree, analysis_results_path,
-                     measure='pg')
+                     measure='pg', workers=os.cpu_count(), reuse=REUSE_RESULTS)
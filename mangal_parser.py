@@ -3,10 +3,15 @@ import re
 import os
 import pathlib
 import csv
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from taxonomy_info import get_nodelist_kingdoms
+from taxonomy_info import get_nodelist_kingdoms, ACCEPTED_KINGDOMS
 
 """
     Parses network using the mangal web API, and converts them to the IWDB format,
@@ -14,20 +19,29 @@ from taxonomy_info import get_nodelist_kingdoms
 """
 
 MANGAL_URL = "https://mangal.io/api/v2/"
+QUERY_PREFETCH = 4  # number of query pages requested concurrently
+MANGAL_SESSION = req.Session()  # reuses connections to mangal between requests
+# keeps a connection per concurrent page request, and retries pages mangal fails to serve
+# momentarily. Once retries run out the failed response is returned, and reported as usual.
+MANGAL_SESSION.mount(MANGAL_URL, HTTPAdapter(
+    pool_maxsize=QUERY_PREFETCH,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], raise_on_status=False)
+))
+POLLINATION_PATTERN = re.compile('pol[li]{1,3}nat|flower.+visit|flower.+interaction', re.IGNORECASE)
+NON_POLLINATION_PATTERN = re.compile('food.web|pelagic|predat', re.IGNORECASE)
+KINGDOM_CACHE = dict()  # kingdoms found by taxonomy web services, by kingdom_cache_key
 
 
 def mangal_base_request(request_specifier, session):
     """
     The base function for requesting information from mangal.
     :param request_specifier: string specifier about the request.
-    :param session: a requests.session object to send requests from.
+    :param session: a requests.session object to send requests from, defaults
+    to the module's shared session.
     :return: mangal response as a json dictionary.
     """
     request = MANGAL_URL + request_specifier
-    if session:
-        response = session.get(request)
-    else:
-        response = req.get(request)
+    response = (session or MANGAL_SESSION).get(request)
 
     if not response.ok:
         raise ConnectionError("request '{0}' failed with error code {1}.".format(
@@ -60,29 +74,39 @@ def mangal_request_by_query(data_type, query_parameter, session=None):
     :param session: a requests.session object to send requests from.
     :return: mangal response as a json dictionary.
     """
-    query_text = "{data_type}?{query}".format(data_type=data_type, query="&".join(
-        ["=".join([key, str(val)]) for key, val in query_parameter.items()])
-    )
+    query_text = "{data_type}?{query}".format(data_type=data_type, query=urlencode(query_parameter))
     return mangal_base_request(query_text, session)
 
 
-def query_iterator(data_type, query):
+def query_iterator(data_type, query, prefetch=QUERY_PREFETCH):
     """
     A generator function for mangal queries. Iterates over all entries from
     the query by the same ordering as they're retrieved from mangal, no matter
     over how many pages the query spans.
     :param data_type: data type of the query elements.
     :param query: a dictionary of query key-value elements (is not kwargs for a reason).
+    :param prefetch: number of pages to request concurrently once the query
+    spans more than one page.
     :return: an iterator of query results.
     """
-    iter_query = dict(query)
-    iter_query['page'] = 0
-    request_page = mangal_request_by_query(data_type, iter_query)
-    while request_page:
-        for entry in request_page:
-            yield entry
-        iter_query['page'] = iter_query['page'] + 1
-        request_page = mangal_request_by_query(data_type, iter_query)
+    def get_page(page):
+        return mangal_request_by_query(data_type, dict(query, page=page))
+
+    request_page = get_page(0)
+    if not request_page:
+        return
+    yield from request_page
+
+    # most queries fit in a single page, later pages are requested in
+    # concurrent batches until the first empty page.
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        next_page = 1
+        while True:
+            for request_page in executor.map(get_page, range(next_page, next_page + prefetch)):
+                if not request_page:
+                    return
+                yield from request_page
+            next_page += prefetch
 
 
 def get_network_metadata(network_id):
@@ -93,6 +117,23 @@ def get_network_metadata(network_id):
     return mangal_request_by_id("network", network_id)
 
 
+def kingdom_cache_key(node):
+    """
+    Creates the KINGDOM_CACHE key of a node, from the same taxonomy information
+    get_nodelist_kingdoms looks the node's kingdom up by: its mangal taxonomy, then
+    its taxonomy id, and only if neither exists its original name. Placeholder names
+    (e.g. 'sp1') recur across networks for unrelated taxa, so nodes with a taxonomy
+    are never keyed by name.
+    :param node: node as returned from mangal.
+    :return: a hashable key of the node's taxonomy.
+    """
+    if node.get('taxonomy') is not None:
+        return 'taxonomy', node['taxonomy']['id']
+    if node.get('taxonomy_id') is not None:
+        return 'taxonomy', node['taxonomy_id']
+    return 'name', node['original_name']
+
+
 def get_network_nodes(network_id, node_kingdoms=None, force_web=False):
     """
     gets all vertices of a network, finding their kingdom either from a file
@@ -100,7 +141,8 @@ def get_network_nodes(network_id, node_kingdoms=None, force_web=False):
     :param network_id: network id of the requested nodes.
     :param node_kingdoms: a preloaded dictionary of node kingdoms. If no such dictionary exists,
     a new one will be generated from taxonomy web services.
-    :param force_web: set to true to force using web services for node kingdoms.
+    :param force_web: set to true to force using web services for node kingdoms. Kingdoms
+    already found by web services for nodes of the same taxonomy are reused.
     :return: a list of nodes as dictionaries (not namedtuples for kingdom completion mutability)
     """
     raw_nodes = []
@@ -110,7 +152,14 @@ def get_network_nodes(network_id, node_kingdoms=None, force_web=False):
         node_counter += 1
 
     if force_web or not node_kingdoms:
-        node_kingdoms = get_nodelist_kingdoms(raw_nodes)
+        # species recur across networks, so only taxa with no known kingdom are looked up.
+        node_keys = {node['id']: kingdom_cache_key(node) for node in raw_nodes}
+        node_kingdoms = {nid: KINGDOM_CACHE[key] for nid, key in node_keys.items() if key in KINGDOM_CACHE}
+        unknown_nodes = [node for node in raw_nodes if node['id'] not in node_kingdoms]
+        if unknown_nodes:
+            node_kingdoms.update(get_nodelist_kingdoms(unknown_nodes))
+        KINGDOM_CACHE.update((node_keys[node['id']], node_kingdoms[node['id']]) for node in unknown_nodes
+                             if node_kingdoms.get(node['id']) in ACCEPTED_KINGDOMS)
     all_nodes = {node['id']: {"id": node['id'], "name": node['original_name'],
                               "kingdom": node_kingdoms.get(node['id'], '')}
                  for node in raw_nodes}
@@ -119,6 +168,17 @@ def get_network_nodes(network_id, node_kingdoms=None, force_web=False):
     return all_nodes
 
 
+def edge_key(node1, node2):
+    """
+    Creates a key for the undirected edge between two nodes, which is the same
+    for both edge directions.
+    :param node1: id of one node of the edge.
+    :param node2: id of the other node of the edge.
+    :return: tuple of the node ids in sorted order.
+    """
+    return (node1, node2) if node1 <= node2 else (node2, node1)
+
+
 def get_network_edges(network_id):
     """
     gets all edges (interactions in mangal) of a network. Checks for network integrity
@@ -133,14 +193,14 @@ def get_network_edges(network_id):
         edge_counter += 1
         e_from = edge['node_to']
         e_to = edge['node_from']
-        existing_id = edge_dict.get(frozenset((e_from, e_to)), -1)
+        e_key = edge_key(e_from, e_to)
 
-        assert existing_id != edge['id'], \
+        assert e_key not in edge_dict, \
             "Multiple edges from {0} to {1}, keys {2} and {3}".format(
-                e_from, e_to, edge['id'], existing_id)
+                e_from, e_to, edge['id'], edge_dict[e_key]['edge_id'])
         assert edge['value'] != 0, "Edge from {} to {} has value 0".format(e_from, e_to)
 
-        edge_dict[frozenset((edge['node_from'], edge['node_to']))] = \
+        edge_dict[e_key] = \
             {'value': edge['value'], 'edge_id': edge['id']}  # , 'lid': edge_counter}
 
     assert edge_counter == len(edge_dict), f"total interactions should be {edge_counter}, are {len(edge_dict)}"
@@ -154,17 +214,10 @@ def construct_adjacency_list(adjacency_matrix):
     :param adjacency_matrix: an adjacency matrix representation of a network.
     :return: a dictionary mapping between each node id and its neighbours.
     """
-    network_adjacency = dict()
+    network_adjacency = defaultdict(list)
     for src, dest in adjacency_matrix.keys():
-        if src in network_adjacency:
-            network_adjacency[src].append(dest)
-        else:
-            network_adjacency[src] = [dest]
-
-        if dest in network_adjacency:
-            network_adjacency[dest].append(src)
-        else:
-            network_adjacency[dest] = [src]
+        network_adjacency[src].append(dest)
+        network_adjacency[dest].append(src)
 
     return network_adjacency
 
@@ -179,31 +232,30 @@ def complete_kingdoms_by_interactions(nodes, edges):
     :return: the number of nodes still missing a kingdom after inferring by
     interactions.
     """
-    network_adjacency = construct_adjacency_list(edges)
-    unresolved_nodes = len(nodes)
-    current_unresolved = sum(
-        map(lambda val: 1 if not val['kingdom'] else 0, nodes.values())
-    )
-
-    while unresolved_nodes > current_unresolved > 0:
-        unresolved_nodes = current_unresolved
-        current_unresolved = 0
+    search_queue = deque(node for node in nodes.values() if node['kingdom'])
+    unresolved_nodes = len(nodes) - len(search_queue)
+    if not search_queue or not unresolved_nodes:
+        return unresolved_nodes  # no kingdoms to infer or nothing to infer them from
 
-        for node in nodes.values():
-            if node['kingdom']:
-                continue
-            node_neighbors = network_adjacency.get(node['id'], [])
-            neighbor_kingdoms = {nodes[neighbor]['kingdom'] for neighbor in node_neighbors} - {''}
-            assert len(neighbor_kingdoms) < 2, \
-                "Network is not bipartite for vertex {0}: {1}".format(
-                node['id'], {n: nodes[n]['kingdom'] for n in node_neighbors})
-
-            if not neighbor_kingdoms:
-                current_unresolved += 1
-            else:
-                node['kingdom'] = 'Animalia' if 'Plantae' in neighbor_kingdoms else 'Plantae'
+    network_adjacency = construct_adjacency_list(edges)
 
-    return current_unresolved
+    # kingdoms spread out from the classified nodes in a breadth first search,
+    # classifying each node once by the kingdom of the neighbour reaching it first.
+    inferred_from = dict()
+    while search_queue:
+        node = search_queue.popleft()
+        for neighbor in network_adjacency.get(node['id'], []):
+            neighbor_node = nodes[neighbor]
+            if not neighbor_node['kingdom']:
+                neighbor_node['kingdom'] = 'Animalia' if node['kingdom'] == 'Plantae' else 'Plantae'
+                inferred_from[neighbor] = node['kingdom']
+                search_queue.append(neighbor_node)
+            elif neighbor in inferred_from:
+                assert inferred_from[neighbor] == node['kingdom'], \
+                    "Network is not bipartite for vertex {0}: {1}".format(
+                    neighbor, {n: nodes[n]['kingdom'] for n in network_adjacency[neighbor]})
+
+    return sum(1 for node in nodes.values() if not node['kingdom'])
 
 
 def is_pollination_network(network_description):
@@ -214,11 +266,8 @@ def is_pollination_network(network_description):
     :param network_description: description of the network in question.
     :return: true if network is a plant pollinator network, false otherwise.
     """
-    including_criteria = ['pol[li]{1,3}nat', 'flower.+visit', 'flower.+interaction']
-    excluding_criteria = ['food.web', 'pelagic', 'predat']
-
-    included = any([re.search(pat, network_description.lower()) is not None for pat in including_criteria])
-    excluded = any([re.search(pat, network_description.lower()) is not None for pat in excluding_criteria])
+    included = POLLINATION_PATTERN.search(network_description) is not None
+    excluded = NON_POLLINATION_PATTERN.search(network_description) is not None
     return included and not excluded
 
 
@@ -230,12 +279,12 @@ def load_network_taxonomy(network_id, load_path):
     :return: a dictionary of node ids mapped to kingdom if a
     taxonomy file exists, otherwise None.
     """
-    taxonomy_filename = 'net{0}'.format(network_id)
-    if taxonomy_filename not in os.listdir(load_path):
+    taxonomy_file = pathlib.Path(load_path).joinpath('net{0}'.format(network_id))
+    if not taxonomy_file.is_file():
         return
 
     taxonomy_dict = dict()
-    with open(load_path.joinpath(taxonomy_filename), 'r') as tax_file:
+    with open(taxonomy_file, 'r') as tax_file:
         plant_line = tax_file.readline()[:-1]
         for node_id in plant_line.split('|'):
             taxonomy_dict[int(node_id)] = 'Plantae'
@@ -273,9 +322,7 @@ def store_network_taxonomy(network_id, network_nodes, store_path):
 
     store_path = pathlib.Path(store_path).joinpath('net{0}'.format(network_id))
     with open(store_path, 'w+') as store_file:
-        store_file.write('|'.join(plants) + '\n')
-        store_file.write('|'.join(pollinators) + '\n')
-        store_file.write('|'.join(unknowns) + '\n')
+        store_file.write(''.join('|'.join(ids) + '\n' for ids in (plants, pollinators, unknowns)))
 
 
 def network_to_csv(nodes, edges, csv_path):
@@ -288,18 +335,21 @@ def network_to_csv(nodes, edges, csv_path):
     """
     plant_nodes = [nodes[nid] for nid in nodes if nodes[nid]['kingdom'] == 'Plantae']
     pollinator_nodes = [nodes[nid] for nid in nodes if nodes[nid]['kingdom'] == 'Animalia']
+
+    # preallocate the rows and scatter the edges into them, rather than
+    # looking up the edge key of every plant-pollinator pair.
+    plant_rows = {plant['id']: [plant['name']] + [0] * len(pollinator_nodes) for plant in plant_nodes}
+    pollinator_columns = {poll['id']: column for column, poll in enumerate(pollinator_nodes, start=1)}
+    for node_pair, edge in edges.items():
+        plant_ids = [nid for nid in node_pair if nid in plant_rows]
+        pollinator_ids = [nid for nid in node_pair if nid in pollinator_columns]
+        if plant_ids and pollinator_ids:
+            plant_rows[plant_ids[0]][pollinator_columns[pollinator_ids[0]]] = edge['value']
+
     with open(csv_path, 'w+', newline='') as csvfile:
         net_writer = csv.writer(csvfile, delimiter=',')
         net_writer.writerow([''] + [poll['name'] for poll in pollinator_nodes])
-        for plant in plant_nodes:
-            plant_row = [plant['name']]
-            for poll in pollinator_nodes:
-                node_pair = frozenset((plant['id'], poll['id']))
-                edge_value = 0
-                if node_pair in edges:
-                    edge_value = edges[node_pair]['value']
-                plant_row.append(edge_value)
-            net_writer.writerow(plant_row)
+        net_writer.writerows(plant_rows[plant['id']] for plant in plant_nodes)
 
 
 def construct_network(network_id, base_dir, force_web=False, force_csv=False):
@@ -0,0 +1,139 @@
+import unittest
+import random
+
+import pandas as pd
+
+from duplicate_finder import *
+
+
+class NodesetMapping(unittest.TestCase):
+    def test_full_name_mapping(self):
+        """
+        Test that nodes with identical names in both sets are mapped to each other,
+        and nodes with no counterpart are reported as unmapped and mapped to None.
+        """
+        set1 = {'Bombus terrestris', 'Apis mellifera', 'Salix alba'}
+        set2 = {'Bombus terrestris', 'Apis mellifera', 'Rosa canina'}
+        map12, map21, unmapped1, unmapped2 = map_nodeset(set1, set2)
+
+        self.assertEqual(map12, {'Bombus terrestris': 'Bombus terrestris',
+                                 'Apis mellifera': 'Apis mellifera',
+                                 'Salix alba': None})
+        self.assertEqual(map21, {'Bombus terrestris': 'Bombus terrestris',
+                                 'Apis mellifera': 'Apis mellifera',
+                                 'Rosa canina': None})
+        self.assertEqual(unmapped1, {'Salix alba'})
+        self.assertEqual(unmapped2, {'Rosa canina'})
+
+    def test_pattern_mapping(self):
+        """
+        Test mapping of unidentified species by their species pattern. Unknown
+        species of the same genus and index should be mapped to each other, and
+        an unknown species with no index may be mapped to a species of the same
+        genus. Species of different genera should never be mapped.
+        """
+        set1 = {'Andrena sp. 1', 'Andrena sp. 2', 'Osmia sp.', 'Halictus sp.'}
+        set2 = {'Andrena sp2', 'Andrena sp1', 'Osmia rufa', 'Lasioglossum sp.'}
+        map12, map21, unmapped1, unmapped2 = map_nodeset(set1, set2)
+
+        self.assertEqual(map12['Andrena sp. 1'], 'Andrena sp1')
+        self.assertEqual(map12['Andrena sp. 2'], 'Andrena sp2')
+        self.assertEqual(map12['Osmia sp.'], 'Osmia rufa')
+        self.assertEqual(unmapped1, {'Halictus sp.'})
+        self.assertEqual(unmapped2, {'Lasioglossum sp.'})
+
+    def test_species_fallback(self):
+        """
+        Test the final mapping round, where species with the same species name
+        but a different genus spelling are mapped to each other.
+        """
+        set1 = {'Bombus terrestris'}
+        set2 = {'B. terrestris'}
+        map12, map21, unmapped1, unmapped2 = map_nodeset(set1, set2)
+
+        self.assertEqual(map12, {'Bombus terrestris': 'B. terrestris'})
+        self.assertEqual(map21, {'B. terrestris': 'Bombus terrestris'})
+        self.assertFalse(unmapped1 or unmapped2)
+
+
+class InteractionComparison(unittest.TestCase):
+    net1 = pd.DataFrame([[1, 0, 2], [0, 3, 0]],
+                        index=['Salix alba', 'Rosa sp. 1'],
+                        columns=['Bombus terrestris', 'Apis mellifera', 'Osmia sp'])
+    net2 = pd.DataFrame([[1, 1], [0, 3]],
+                        index=['Salix alba', 'Rosa sp1'],
+                        columns=['Bombus terrestris', 'Apis mellifera'])
+
+    def test_interaction_counts(self):
+        """
+        Test counting of missing interactions between mapped networks, with
+        and without counting interactions of unmapped nodes and interactions
+        with different values.
+        """
+        plants12, plants21, _, _ = map_nodeset(set(self.net1.index), set(self.net2.index))
+        pols12, pols21, _, _ = map_nodeset(set(self.net1.columns), set(self.net2.columns))
+
+        self.assertEqual(compare_network_interactions(
+            self.net1, self.net2, plants12, plants21, pols12, pols21), (1, 0, 3, 3))
+        self.assertEqual(compare_network_interactions(
+            self.net1, self.net2, plants12, plants21, pols12, pols21,
+            count_nomaps=True), (1, 1, 3, 3))
+
+        net2 = self.net2.copy()
+        net2.iloc[1, 1] = 2
+        self.assertEqual(compare_network_interactions(
+            self.net1, net2, plants12, plants21, pols12, pols21,
+            compare_value=True), (2, 1, 3, 3))
+
+
+class NetworkBlocking(unittest.TestCase):
+    def test_size_candidates(self):
+        """
+        Test that blocking networks by size keeps exactly the network pairs
+        whose plant and pollinator numbers match within the threshold.
+        """
+        shapes = {'a': (10, 20), 'b': (11, 21), 'c': (10, 30), 'd': (14, 20),
+                  'e': (12, 19), 'f': (3, 4), 'g': (3, 5)}
+        networks = {name: pd.DataFrame(index=range(shape[0]), columns=range(shape[1]))
+                    for name, shape in shapes.items()}
+
+        for ct in (0.0, 0.1, 0.25, 0.5):
+            candidates = size_candidates(networks, ct)
+            for name1, name2 in [(n1, n2) for n1 in shapes for n2 in shapes if n1 < n2]:
+                (plants1, pols1), (plants2, pols2) = shapes[name1], shapes[name2]
+                expected = sizes_match(plants1, plants2, ct) and sizes_match(pols1, pols2, ct)
+                self.assertEqual(name2 in candidates[name1], expected, (name1, name2, ct))
+
+    def test_parallel_comparison(self):
+        """
+        Test that comparing networks in worker processes finds the same
+        duplicates as comparing them serially.
+        """
+        net = InteractionComparison.net1
+        networks = {'a': net, 'b': net.rename(index={'Rosa sp. 1': 'Rosa sp1'}),
+                    'c': net.T, 'd': InteractionComparison.net2}
+
+        random.seed(0)
+        serial = compare_all_networks(networks, 0.05)
+        random.seed(0)
+        parallel = compare_all_networks(networks, 0.05, workers=2)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len(serial & {'a', 'b'}), 1)
+
+    def test_unparsed_dropped_networks(self):
+        """
+        Test that networks dropped early are never parsed, so labels that have
+        no species pattern (e.g. numbered species) do not fail the comparison.
+        """
+        net = InteractionComparison.net1
+        numbered = pd.DataFrame(net.values, index=[1, 2], columns=[10, 11, 12])
+        networks = {'a': net, 'b': net.copy(), 'z': numbered}
+
+        for workers in (None, 2):
+            duplicates = compare_all_networks(networks, 0.05, drop_early={'z'}, workers=workers)
+            self.assertIn('z', duplicates)
+            self.assertEqual(len(duplicates & {'a', 'b'}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import tempfile
+
+import pandas as pd
+
+from mainframe import *
+
+
+class NetworkCleaning(unittest.TestCase):
+    faux_network = pd.DataFrame(
+        [[1, 0, 2], [0, 1, 1], [1, 1, 0], [0, 0, 3]],
+        index=['Salix alba', 'Unidentified 1', 'Rosa canina', 'unidentified plant'],
+        columns=['Bombus terrestris', 'UNIDENTIFIED sp.', 'Apis mellifera']
+    )
+
+    def test_unidentified_rate(self):
+        """
+        Test counting of completely unidentified species, which should be case
+        insensitive and separate for plants and pollinators.
+        """
+        self.assertEqual(unidentified_rate(self.faux_network), (0.5, 1 / 3))
+
+    def test_empty_network_rate(self):
+        """
+        Test that networks with no plants or pollinators have no unidentified
+        species, instead of failing on a division by zero.
+        """
+        self.assertEqual(unidentified_rate(self.faux_network.iloc[:0, :0]), (0.0, 0.0))
+        self.assertEqual(unidentified_rate(pd.DataFrame()), (0.0, 0.0))
+
+    def test_clean_networks(self):
+        """
+        Test that clean_networks reports networks with too many unidentified plants,
+        and drops unidentified species only from the requested network sides.
+        """
+        networks = {'partial': self.faux_network.copy(), 'kept': self.faux_network.copy()}
+        partial = clean_networks(networks, plant_threshold=0.25, clean_plants=True)
+
+        self.assertEqual(partial, {'partial', 'kept'})
+        self.assertEqual(list(networks['partial'].index), ['Salix alba', 'Rosa canina'])
+        self.assertEqual(list(networks['partial'].columns), list(self.faux_network.columns))
+
+        networks = {'net': self.faux_network.copy()}
+        partial = clean_networks(networks, plant_threshold=0.5, clean_pollinators=True)
+
+        self.assertEqual(partial, set())
+        self.assertEqual(list(networks['net'].index), list(self.faux_network.index))
+        self.assertEqual(list(networks['net'].columns), ['Bombus terrestris', 'Apis mellifera'])
+
+
+class ResultReuse(unittest.TestCase):
+    network_a = pd.DataFrame(
+        [[3, 1, 2, 1], [1, 0, 2, 0], [2, 1, 0, 0], [1, 0, 0, 0]],
+        index=['Salix alba', 'Rosa canina', 'Viola tricolor', 'Erica arborea'],
+        columns=['Bombus terrestris', 'Apis mellifera', 'Osmia rufa', 'Andrena fulva']
+    )
+    network_b = network_a.iloc[::-1, ::-1]
+    polyploids = {'Rosa canina', 'Viola tricolor'}
+
+    def test_stale_key(self):
+        """
+        Test that a result written without reuse replaces the key of the previous
+        result, so a later run with reuse does not keep a result of other inputs.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_path = pathlib.Path(tmp_dir)
+            result_file = result_path.joinpath('net')
+
+            analyze_network('net', self.network_a, self.polyploids, result_path, reuse=True)
+            result_a = result_file.read_text()
+            analyze_network('net', self.network_b, {'Rosa canina'}, result_path, reuse=False)
+            self.assertNotEqual(result_file.read_text(), result_a)
+
+            analyze_network('net', self.network_a, self.polyploids, result_path, reuse=True)
+            self.assertEqual(result_file.read_text(), result_a)
+            self.assertEqual(result_path.joinpath('.net.key').read_text(),
+                             analysis_key(self.network_a, self.polyploids, 'pg'))
+            self.assertEqual(sorted(path.name for path in result_path.iterdir()), ['.net.key', 'net'])
+
+
+if __name__ == '__main__':
+    unittest.main()
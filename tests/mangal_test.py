@@ -1,4 +1,6 @@
 import unittest
+import tempfile
+from unittest import mock
 from mangal_parser import *
 
 
@@ -95,6 +97,76 @@ class NetworkKingdomCompletion(unittest.TestCase):
                          expected_result)
 
 
+class QueryPaging(unittest.TestCase):
+    @staticmethod
+    def faux_query(pages):
+        """
+        Creates a replacement for mangal_request_by_query serving the given pages,
+        followed by an empty page. Requests for pages after the empty one fail.
+        """
+        def request_by_query(data_type, query_parameter, session=None):
+            page = query_parameter['page']
+            if page < len(pages):
+                return pages[page]
+            if page == len(pages):
+                return []
+            raise ConnectionError(f"page {page} requested after the end of the query")
+        return request_by_query
+
+    def test_query_pages(self):
+        """
+        Test that query_iterator yields all entries of a query in order, whether
+        the query has no pages, a single page or more pages than are requested
+        concurrently, and that failed requests for pages after the end of the
+        query are not raised to the caller.
+        """
+        for page_count in (0, 1, QUERY_PREFETCH + 1):
+            pages = [[{'id': page * 10 + entry} for entry in range(3)] for page in range(page_count)]
+            with mock.patch('mangal_parser.mangal_request_by_query', self.faux_query(pages)):
+                entries = list(query_iterator('node', {'network_id': 1}))
+
+            self.assertEqual(entries, [entry for page in pages for entry in page], page_count)
+
+
+class KingdomCache(unittest.TestCase):
+    def setUp(self):
+        KINGDOM_CACHE.clear()
+
+    def tearDown(self):
+        KINGDOM_CACHE.clear()
+
+    def test_same_name_taxa(self):
+        """
+        Test that kingdoms found for one network are reused for nodes of the same
+        taxonomy in another network, but not for nodes that only share a name with
+        them and have a different taxonomy.
+        """
+        network_nodes = {
+            1: [{'id': 1, 'original_name': 'sp1', 'taxonomy': {'id': 100}},
+                {'id': 2, 'original_name': 'sp2', 'taxonomy': None, 'taxonomy_id': 200}],
+            2: [{'id': 3, 'original_name': 'sp1', 'taxonomy': {'id': 300}},
+                {'id': 4, 'original_name': 'sp2', 'taxonomy': None, 'taxonomy_id': 200}]
+        }
+        taxon_kingdoms = {100: 'Plantae', 200: 'Animalia', 300: 'Animalia'}
+        looked_up = []
+
+        def nodelist_kingdoms(nodes):
+            looked_up.extend(node['id'] for node in nodes)
+            return {node['id']: taxon_kingdoms[kingdom_cache_key(node)[1]] for node in nodes}
+
+        with mock.patch('mangal_parser.get_nodelist_kingdoms', nodelist_kingdoms), \
+                mock.patch('mangal_parser.query_iterator', lambda data_type, query:
+                           iter(network_nodes[query['network_id']])):
+            nodes1 = get_network_nodes(1, force_web=True)
+            nodes2 = get_network_nodes(2, force_web=True)
+
+        self.assertEqual(looked_up, [1, 2, 3])
+        self.assertEqual({nid: node['kingdom'] for nid, node in nodes1.items()},
+                         {1: 'Plantae', 2: 'Animalia'})
+        self.assertEqual({nid: node['kingdom'] for nid, node in nodes2.items()},
+                         {3: 'Animalia', 4: 'Animalia'})
+
+
 class NetworkIO(unittest.TestCase):
     def test_taxonomy_load_store(self):
         """
@@ -110,6 +182,34 @@ class NetworkIO(unittest.TestCase):
         self.assertEqual(nodes_web, nodes_file)
         self.assertEqual(edges_web, edges_file)
 
+    def test_network_to_csv(self):
+        """
+        Tests writing a network to csv, with plants as rows, pollinators as columns
+        and zeros for missing interactions. Nodes with no kingdom and interactions
+        between nodes of the same kingdom should be left out.
+        """
+        faux_vertices = {
+            1: {'id': 1, 'name': 'p1', 'kingdom': 'Plantae'},
+            2: {'id': 2, 'name': 'a2', 'kingdom': 'Animalia'},
+            3: {'id': 3, 'name': 'p3', 'kingdom': 'Plantae'},
+            4: {'id': 4, 'name': 'a4', 'kingdom': 'Animalia'},
+            5: {'id': 5, 'name': 'u5', 'kingdom': ''}
+        }
+        faux_edges = {
+            edge_key(2, 1): {'value': 3, 'edge_id': 10},
+            edge_key(3, 4): {'value': 1, 'edge_id': 11},
+            edge_key(1, 3): {'value': 7, 'edge_id': 12},
+            edge_key(4, 5): {'value': 2, 'edge_id': 13}
+        }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = pathlib.Path(tmp_dir).joinpath('net.csv')
+            network_to_csv(faux_vertices, faux_edges, csv_path)
+            with open(csv_path, newline='') as csv_file:
+                rows = list(csv.reader(csv_file))
+
+        self.assertEqual(rows, [['', 'a2', 'a4'], ['p1', '3', '0'], ['p3', '0', '1']])
+
 
 if __name__ == '__main__':
     unittest.main()